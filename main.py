@@ -1,9 +1,35 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
+from pandas.api.types import is_float_dtype, is_numeric_dtype
 import io
-from openpyxl import Workbook
-from openpyxl.styles import PatternFill, Font
-from openpyxl.utils.dataframe import dataframe_to_rows
+import importlib.util
+
+# Polars is optional and only imported when a comparison is large enough to use it
+POLARS_AVAILABLE = importlib.util.find_spec('polars') is not None
+
+# Combined row count from which the optional Polars backend is used for comparisons
+POLARS_MIN_ROWS = 100_000
+
+# numba is optional and not in requirements.txt; when installed, float compare columns on the
+# pandas path (small inputs, or inputs Polars cannot take) are checked by one compiled kernel
+NUMBA_AVAILABLE = importlib.util.find_spec('numba') is not None
+
+# Number of float compare columns and matched rows from which the compiled kernel is used
+NUMBA_MIN_COLUMNS = 4
+NUMBA_MIN_ROWS = 100_000
+
+# Bounds on the in-memory caches of parsed files, comparison results and reports, which are
+# shared by all sessions of the server
+CACHE_MAX_ENTRIES = 4
+CACHE_TTL_SECONDS = 3600
+
+# Number of rows converted at a time when writing report sheets
+WRITE_CHUNK_ROWS = 10_000
+
+# Copy-on-Write lets slices share data with their parent frame (always on from pandas 3)
+if int(pd.__version__.split('.')[0]) < 3:
+    pd.options.mode.copy_on_write = True
 
 st.set_page_config(page_title="Spreadsheet Comparison Tool", page_icon="📊", layout="wide")
 
@@ -17,6 +43,10 @@ if 'df_before' not in st.session_state:
     st.session_state.df_before = None
 if 'df_after' not in st.session_state:
     st.session_state.df_after = None
+if 'compared_selection' not in st.session_state:
+    st.session_state.compared_selection = None
+if 'report_selection' not in st.session_state:
+    st.session_state.report_selection = None
 
 # File uploaders
 col1, col2 = st.columns(2)
@@ -30,89 +60,268 @@ with col2:
     file_after = st.file_uploader("Upload the 'after' file", type=['csv', 'xls', 'xlsx'], key='after')
 
 
-def read_file(file):
-    """Read various spreadsheet formats"""
-    if file.name.endswith('.csv'):
-        return pd.read_csv(file)
-    elif file.name.endswith(('.xls', '.xlsx')):
-        return pd.read_excel(file)
+def _read_with_fallback(reader, file, engine):
+    """Read into Arrow-backed columns with a fast parsing engine, falling back to the pandas default"""
+    try:
+        return reader(file, engine=engine, dtype_backend='pyarrow')
+    except (ImportError, ValueError):
+        file.seek(0)
+        return reader(file, dtype_backend='pyarrow')
+
+
+@st.cache_data(show_spinner=False, max_entries=CACHE_MAX_ENTRIES, ttl=CACHE_TTL_SECONDS)
+def read_file(file_bytes, name):
+    """Read various spreadsheet formats (cached on the file contents)"""
+    if name.endswith('.csv'):
+        return _read_with_fallback(pd.read_csv, io.BytesIO(file_bytes), engine='pyarrow')
+    elif name.endswith(('.xls', '.xlsx')):
+        return _read_with_fallback(pd.read_excel, io.BytesIO(file_bytes), engine='calamine')
     return None
 
 
+def _types_disagree(dtype_before, dtype_after):
+    """Whether the two files' types for a column can only be compared as text"""
+    return dtype_before != dtype_after and not (is_numeric_dtype(dtype_before) and is_numeric_dtype(dtype_after))
+
+
+def _text_key_columns(df_before, df_after, key_columns):
+    """Identifier columns whose types differ between the files, so they must be matched as text"""
+    return [col for col in key_columns if _types_disagree(df_before[col].dtype, df_after[col].dtype)]
+
+
+def _key_codes(df_before, df_after, key_columns):
+    """Factorize the identifier columns of both frames into shared integer row codes"""
+    keys_before, keys_after = df_before[key_columns], df_after[key_columns]
+    text_columns = _text_key_columns(df_before, df_after, key_columns)
+    if text_columns:
+        # Arrow integers with missing values stringify as '1.0' on pandas 2.x unless cast to strings
+        keys_before = keys_before.astype({col: 'string[pyarrow]' for col in text_columns})
+        keys_after = keys_after.astype({col: 'string[pyarrow]' for col in text_columns})
+    stacked = pd.concat([keys_before, keys_after], ignore_index=True)
+    if len(key_columns) == 1:
+        # A single identifier column can be encoded directly, without building a MultiIndex
+        codes, _ = pd.factorize(stacked[key_columns[0]], use_na_sentinel=False)
+    else:
+        codes, _ = pd.factorize(pd.MultiIndex.from_frame(stacked))
+    return codes[:len(df_before)], codes[len(df_before):]
+
+
+def _values_differ(before, after):
+    """Element-wise inequality of two columns matched by position, treating two missing values as equal"""
+    after = after.set_axis(before.index)
+    same_numpy_dtype = before.dtype == after.dtype and isinstance(before.dtype, np.dtype)
+    if same_numpy_dtype and before.dtype.kind in 'iub':
+        # Plain numpy integers and booleans cannot hold missing values
+        return before.to_numpy() != after.to_numpy()
+    if same_numpy_dtype and before.dtype.kind in 'fmM':
+        # NaN != NaN and NaT != NaT, so pairs of missing values are masked out
+        values_before, values_after = before.to_numpy(), after.to_numpy()
+        is_missing = np.isnan if before.dtype.kind == 'f' else np.isnat
+        return (values_before != values_after) & ~(is_missing(values_before) & is_missing(values_after))
+
+    both_missing = before.isna().to_numpy() & after.isna().to_numpy()
+    if _types_disagree(before.dtype, after.dtype):
+        # The files disagree on the column's type, so compare the values as text; the string dtype
+        # keeps missing values missing and formats Arrow integers the same on every pandas version
+        before, after = before.astype('string[pyarrow]'), after.astype('string[pyarrow]')
+    differ = before.ne(after).to_numpy(dtype=bool, na_value=True)
+    return differ & ~both_missing
+
+
+def _compare_with_polars(df_before, df_after, key_columns, compare_columns):
+    """Lazy Polars version of compare_dataframes, used for large inputs"""
+    import polars as pl
+
+    cols_to_use = key_columns + compare_columns
+
+    # Join on copies of the identifier columns, cast to text where the files disagree on their type
+    text_columns = _text_key_columns(df_before, df_after, key_columns)
+    join_keys = [f"{col}__key" for col in key_columns]
+    key_exprs = [
+        (pl.col(col).cast(pl.Utf8) if col in text_columns else pl.col(col)).alias(join_key)
+        for col, join_key in zip(key_columns, join_keys)
+    ]
+    # Each file's row labels ride along in a _row column so the results keep them
+    lazy_before = pl.from_pandas(df_before[cols_to_use].assign(_row=df_before.index)).lazy().with_columns(key_exprs)
+    lazy_after = pl.from_pandas(df_after[cols_to_use].assign(_row=df_after.index)).lazy().with_columns(key_exprs)
+
+    deleted = lazy_before.join(lazy_after, on=join_keys, how='anti')
+    added = lazy_after.join(lazy_before, on=join_keys, how='anti')
+
+    schema_before, schema_after = lazy_before.collect_schema(), lazy_after.collect_schema()
+    changed = []
+    for col in compare_columns:
+        value_before, value_after = pl.col(col), pl.col(f"{col}__a")
+        dtype_before, dtype_after = schema_before[col], schema_after[col]
+        if dtype_before != dtype_after and not (dtype_before.is_numeric() and dtype_after.is_numeric()):
+            value_before, value_after = value_before.cast(pl.Utf8), value_after.cast(pl.Utf8)
+        changed.append(value_before.ne_missing(value_after))
+    modified = lazy_before.join(
+        lazy_after, on=join_keys, how='inner', suffix='__a', validate='1:1'
+    ).filter(pl.any_horizontal(changed))
+
+    deleted, added, modified = (
+        frame.to_pandas(use_pyarrow_extension_array=True) for frame in pl.collect_all([deleted, added, modified])
+    )
+    return (
+        _merged_side(deleted, slice(None), '', df_before, cols_to_use),
+        _merged_side(added, slice(None), '', df_after, cols_to_use),
+        _merged_side(modified, slice(None), '', df_before, cols_to_use),
+        _merged_side(modified, slice(None), '__a', df_after, cols_to_use),
+    )
+
+
+def _float_rows_differ(before, after):
+    """Row-wise 'any value differs' over float columns in a single compiled pass over memory"""
+    values_before = before.to_numpy(dtype=np.float64, na_value=np.nan)
+    values_after = after.to_numpy(dtype=np.float64, na_value=np.nan)
+    # Imported here so numba is only loaded (and the kernel compiled or read from its disk cache) when used
+    from numba_kernels import rows_differ
+    return rows_differ(values_before, values_after)
+
+
+def _merged_side(merged, mask, suffix, source, cols_to_use):
+    """One file's rows from a joined frame, with that file's columns, dtypes and row labels"""
+    side = merged.loc[mask, [f"{col}{suffix}" for col in cols_to_use]].set_axis(cols_to_use, axis=1)
+    # Unmatched rows are padded with missing values, which upcasts e.g. int64 columns, and Polars
+    # results come back with its own types; the selected rows all come from one file, so its
+    # original dtypes can be restored
+    side = side.astype(source[cols_to_use].dtypes)
+    rows = merged.loc[mask, f"_row{suffix}"].to_numpy()
+    side.index = pd.Index(rows, dtype=source.index.dtype, name=source.index.name)
+    return side
+
+
 def compare_dataframes(df_before, df_after, key_columns, compare_columns):
     """Compare two dataframes and identify differences"""
-    # Create composite keys from multiple identifier columns
-    df_before['_key'] = df_before[key_columns].astype(str).agg('||'.join, axis=1)
-    df_after['_key'] = df_after[key_columns].astype(str).agg('||'.join, axis=1)
+    # Polars does not match missing keys in joins, so those inputs stay on the pandas path
+    if (POLARS_AVAILABLE and len(df_before) + len(df_after) >= POLARS_MIN_ROWS
+            and not df_before[key_columns].isna().any(axis=None)
+            and not df_after[key_columns].isna().any(axis=None)):
+        import polars as pl
+        import pyarrow as pa
+
+        try:
+            return _compare_with_polars(df_before, df_after, key_columns, compare_columns)
+        except (pl.exceptions.PolarsError, pa.ArrowInvalid, TypeError):
+            # e.g. mixed-type object columns Polars cannot convert, or duplicate keys; the pandas
+            # path handles the former and reports the latter
+            pass
+
+    # Encode composite keys from multiple identifier columns as integer codes
+    codes_before, codes_after = _key_codes(df_before, df_after, key_columns)
 
     # Select only key columns and compare columns for analysis
     cols_to_use = key_columns + compare_columns
 
+    # Each key may match at most one row per file
+    for codes, label in ((codes_before, 'Before'), (codes_after, 'After')):
+        if not pd.Index(codes).is_unique:
+            raise ValueError(f"The identifier columns do not uniquely identify each row in the '{label}' file.")
+
+    # Partition both files in a single outer hash join on the integer codes, carrying each
+    # file's row labels along so the results keep them
+    merged = df_before[cols_to_use].assign(_row=df_before.index).merge(
+        df_after[cols_to_use].assign(_row=df_after.index), left_on=codes_before, right_on=codes_after,
+        how='outer', suffixes=('__b', '__a'), indicator=True
+    )
+    before_dtypes = df_before[cols_to_use].dtypes
+    after_dtypes = df_after[cols_to_use].dtypes
+
     # Find deleted rows (in before but not in after)
-    deleted_keys = df_before[~df_before['_key'].isin(df_after['_key'])]
-    deleted = deleted_keys[cols_to_use].copy()
+    deleted = _merged_side(merged, merged['_merge'] == 'left_only', '__b', df_before, cols_to_use)
 
     # Find added rows (in after but not in before)
-    added_keys = df_after[~df_after['_key'].isin(df_before['_key'])]
-    added = added_keys[cols_to_use].copy()
+    added = _merged_side(merged, merged['_merge'] == 'right_only', '__a', df_after, cols_to_use)
+
+    in_both = merged['_merge'] == 'both'
+    common_before = _merged_side(merged, in_both, '__b', df_before, cols_to_use)
+    common_after = _merged_side(merged, in_both, '__a', df_after, cols_to_use)
+
+    # Float columns can all be checked in one compiled pass when numba is installed
+    float_columns = [
+        col for col in compare_columns if is_float_dtype(before_dtypes[col]) and is_float_dtype(after_dtypes[col])
+    ]
+    if not NUMBA_AVAILABLE or len(float_columns) < NUMBA_MIN_COLUMNS or len(common_before) < NUMBA_MIN_ROWS:
+        float_columns = []
+    other_columns = [col for col in compare_columns if col not in float_columns]
 
     # Find modified rows (same key but different values in compare columns)
-    common_keys = set(df_before['_key']) & set(df_after['_key'])
+    differs = np.empty((len(common_before), len(other_columns)), dtype=bool)
+    for i, col in enumerate(other_columns):
+        differs[:, i] = _values_differ(common_before[col], common_after[col])
+    changed = differs.any(axis=1)
+    if float_columns:
+        changed |= _float_rows_differ(common_before[float_columns], common_after[float_columns])
 
-    modified_before = []
-    modified_after = []
+    modified_before_df = common_before[changed]
+    modified_after_df = common_after[changed]
 
-    for key in common_keys:
-        row_before = df_before[df_before['_key'] == key][cols_to_use].iloc[0]
-        row_after = df_after[df_after['_key'] == key][cols_to_use].iloc[0]
+    return deleted, added, modified_before_df, modified_after_df
 
-        # Check if any of the compare columns have changed
-        has_changes = False
-        for col in compare_columns:
-            if str(row_before[col]) != str(row_after[col]):
-                has_changes = True
-                break
 
-        if has_changes:
-            modified_before.append(row_before)
-            modified_after.append(row_after)
+@st.cache_data(show_spinner=False, max_entries=CACHE_MAX_ENTRIES, ttl=CACHE_TTL_SECONDS)
+def run_compare(before_bytes, before_name, after_bytes, after_name, key_columns, compare_columns):
+    """Compare two uploaded files (cached on the file contents and column selections)"""
+    df_before = read_file(before_bytes, before_name)
+    df_after = read_file(after_bytes, after_name)
+    return compare_dataframes(df_before, df_after, list(key_columns), list(compare_columns))
 
-    modified_before_df = pd.DataFrame(modified_before) if modified_before else pd.DataFrame(columns=cols_to_use)
-    modified_after_df = pd.DataFrame(modified_after) if modified_after else pd.DataFrame(columns=cols_to_use)
 
-    return deleted, added, modified_before_df, modified_after_df
+@st.cache_data(show_spinner=False, max_entries=CACHE_MAX_ENTRIES, ttl=CACHE_TTL_SECONDS)
+def build_report(before_bytes, before_name, after_bytes, after_name, key_columns, compare_columns):
+    """Build the Excel report for a comparison (cached on the same inputs as run_compare)"""
+    results = run_compare(before_bytes, before_name, after_bytes, after_name, key_columns, compare_columns)
+    return create_excel_output(*results).getvalue()
+
+
+def _write_sheet(workbook, sheet_name, df, empty_message):
+    """Write a dataframe row by row, as xlsxwriter's constant-memory mode requires"""
+    worksheet = workbook.add_worksheet(sheet_name)
+    if df.empty:
+        worksheet.write(0, 0, empty_message)
+        return
+
+    header_format = workbook.add_format({'bold': True})
+    worksheet.write_row(0, 0, [str(col) for col in df.columns], header_format)
+    for start in range(0, len(df), WRITE_CHUNK_ROWS):
+        chunk = df.iloc[start:start + WRITE_CHUNK_ROWS]
+        # Blank out missing values column by column instead of checking every cell in Python
+        columns = [chunk[col].astype(object).where(chunk[col].notna(), None).tolist() for col in chunk.columns]
+        for row_number, row in enumerate(zip(*columns), start=start + 1):
+            worksheet.write_row(row_number, 0, row)
 
 
 def create_excel_output(deleted, added, modified_before, modified_after):
     """Create Excel file with formatted sheets"""
     output = io.BytesIO()
 
-    with pd.ExcelWriter(output, engine='openpyxl') as writer:
+    # Infinite floats are written as Excel error values; xlsxwriter refuses them otherwise
+    engine_kwargs = {'options': {
+        'constant_memory': True, 'default_date_format': 'yyyy-mm-dd hh:mm:ss', 'nan_inf_to_errors': True
+    }}
+    with pd.ExcelWriter(output, engine='xlsxwriter', engine_kwargs=engine_kwargs) as writer:
         # Write deleted rows
-        if not deleted.empty:
-            deleted.to_excel(writer, sheet_name='Deleted', index=False)
-        else:
-            pd.DataFrame(['No deleted rows']).to_excel(writer, sheet_name='Deleted', index=False, header=False)
+        _write_sheet(writer.book, 'Deleted', deleted, 'No deleted rows')
 
         # Write added rows
-        if not added.empty:
-            added.to_excel(writer, sheet_name='Added', index=False)
-        else:
-            pd.DataFrame(['No added rows']).to_excel(writer, sheet_name='Added', index=False, header=False)
+        _write_sheet(writer.book, 'Added', added, 'No added rows')
 
         # Write modified rows (before and after side by side)
         if not modified_before.empty:
-            # Rename columns to distinguish before/after
-            modified_before_renamed = modified_before.copy()
-            modified_after_renamed = modified_after.copy()
-
-            modified_before_renamed.columns = [f"{col} (Before)" for col in modified_before.columns]
-            modified_after_renamed.columns = [f"{col} (After)" for col in modified_after.columns]
-
-            modified_combined = pd.concat([modified_before_renamed, modified_after_renamed], axis=1)
-            modified_combined.to_excel(writer, sheet_name='Modified', index=False)
+            # Suffix column names to distinguish before/after; under Copy-on-Write add_suffix, set_axis
+            # and concat share the columns' data rather than copying it. The after rows carry that
+            # file's row labels, so they are lined up by position
+            modified_combined = pd.concat(
+                [
+                    modified_before.add_suffix(' (Before)'),
+                    modified_after.add_suffix(' (After)').set_axis(modified_before.index),
+                ],
+                axis=1
+            )
         else:
-            pd.DataFrame(['No modified rows']).to_excel(writer, sheet_name='Modified', index=False, header=False)
+            modified_combined = modified_before
+        _write_sheet(writer.book, 'Modified', modified_combined, 'No modified rows')
 
     output.seek(0)
     return output
@@ -122,8 +331,8 @@ def create_excel_output(deleted, added, modified_before, modified_after):
 if file_before and file_after:
     try:
         # Read files
-        df_before = read_file(file_before)
-        df_after = read_file(file_after)
+        df_before = read_file(file_before.getvalue(), file_before.name)
+        df_after = read_file(file_after.getvalue(), file_after.name)
 
         if df_before is None or df_after is None:
             st.error("Error reading files. Please check file formats.")
@@ -207,50 +416,68 @@ if file_before and file_after:
 
                             st.markdown("---")
 
+                            # Identifies the current uploads and column selections
+                            selection = (
+                                file_before.name, file_before.size, file_after.name, file_after.size,
+                                tuple(key_columns), tuple(compare_columns)
+                            )
+
                             # Compare button
                             if st.button("🔍 Compare Files", type="primary", use_container_width=True):
+                                st.session_state.compared_selection = selection
+
+                            # Keep showing the results on later reruns until the selection changes
+                            if st.session_state.compared_selection == selection:
+                                compare_args = (
+                                    file_before.getvalue(), file_before.name, file_after.getvalue(), file_after.name,
+                                    tuple(key_columns), tuple(compare_columns)
+                                )
                                 with st.spinner("Comparing files..."):
-                                    deleted, added, modified_before, modified_after = compare_dataframes(
-                                        df_before.copy(), df_after.copy(), key_columns, compare_columns
-                                    )
+                                    deleted, added, modified_before, modified_after = run_compare(*compare_args)
+
+                                # Display summary
+                                st.subheader("📊 Comparison Summary")
+                                col1, col2, col3 = st.columns(3)
+
+                                with col1:
+                                    st.metric("🗑️ Deleted Rows", len(deleted))
+                                with col2:
+                                    st.metric("➕ Added Rows", len(added))
+                                with col3:
+                                    st.metric("✏️ Modified Rows", len(modified_before))
+
+                                # Show previews
+                                if not deleted.empty:
+                                    with st.expander("🗑️ View Deleted Rows", expanded=False):
+                                        st.dataframe(deleted, use_container_width=True)
+
+                                if not added.empty:
+                                    with st.expander("➕ View Added Rows", expanded=False):
+                                        st.dataframe(added, use_container_width=True)
+
+                                if not modified_before.empty:
+                                    with st.expander("✏️ View Modified Rows", expanded=False):
+                                        col_a, col_b = st.columns(2)
+                                        with col_a:
+                                            st.write("**Before:**")
+                                            st.dataframe(modified_before, use_container_width=True)
+                                        with col_b:
+                                            st.write("**After:**")
+                                            st.dataframe(modified_after, use_container_width=True)
+
+                                if deleted.empty and added.empty and modified_before.empty:
+                                    st.info("ℹ️ No differences found between the files based on selected columns.")
+
+                                st.markdown("---")
+
+                                # Generate Excel output only when asked for
+                                if st.button("📄 Generate Comparison Report (Excel)", use_container_width=True):
+                                    st.session_state.report_selection = selection
+
+                                if st.session_state.report_selection == selection:
+                                    with st.spinner("Generating report..."):
+                                        excel_output = build_report(*compare_args)
 
-                                    # Display summary
-                                    st.subheader("📊 Comparison Summary")
-                                    col1, col2, col3 = st.columns(3)
-
-                                    with col1:
-                                        st.metric("🗑️ Deleted Rows", len(deleted))
-                                    with col2:
-                                        st.metric("➕ Added Rows", len(added))
-                                    with col3:
-                                        st.metric("✏️ Modified Rows", len(modified_before))
-
-                                    # Show previews
-                                    if not deleted.empty:
-                                        with st.expander("🗑️ View Deleted Rows", expanded=False):
-                                            st.dataframe(deleted, use_container_width=True)
-
-                                    if not added.empty:
-                                        with st.expander("➕ View Added Rows", expanded=False):
-                                            st.dataframe(added, use_container_width=True)
-
-                                    if not modified_before.empty:
-                                        with st.expander("✏️ View Modified Rows", expanded=False):
-                                            col_a, col_b = st.columns(2)
-                                            with col_a:
-                                                st.write("**Before:**")
-                                                st.dataframe(modified_before, use_container_width=True)
-                                            with col_b:
-                                                st.write("**After:**")
-                                                st.dataframe(modified_after, use_container_width=True)
-
-                                    if deleted.empty and added.empty and modified_before.empty:
-                                        st.info("ℹ️ No differences found between the files based on selected columns.")
-
-                                    # Generate Excel output
-                                    excel_output = create_excel_output(deleted, added, modified_before, modified_after)
-
-                                    st.markdown("---")
                                     st.download_button(
                                         label="📥 Download Comparison Report (Excel)",
                                         data=excel_output,
@@ -260,7 +487,7 @@ if file_before and file_after:
                                         use_container_width=True
                                     )
 
-                                    st.success("✅ Comparison complete!")
+                                st.success("✅ Comparison complete!")
                         else:
                             st.warning("⚠️ Please select at least one column to compare.")
                     else:
@@ -297,5 +524,5 @@ st.markdown("""
 4. **Select identifiers**: Choose one or more columns that uniquely identify each row
 5. **Select compare columns**: Choose which columns to compare (exclude noise/irrelevant columns)
 6. **Compare**: Click 'Compare Files' to analyze differences
-7. **Download**: Get an Excel report with three sheets (Deleted, Added, Modified rows)
+7. **Download**: Generate and download an Excel report with three sheets (Deleted, Added, Modified rows)
 """)
\ No newline at end of file
@@ -0,0 +1,15 @@
+import numpy as np
+from numba import njit, prange
+
+
+@njit(parallel=True, cache=True)
+def rows_differ(before, after):
+    """Whether any value differs per row of two float matrices, treating two NaNs as equal"""
+    changed = np.zeros(before.shape[0], dtype=np.bool_)
+    for i in prange(before.shape[0]):
+        for j in range(before.shape[1]):
+            value_before, value_after = before[i, j], after[i, j]
+            if value_before != value_after and not (np.isnan(value_before) and np.isnan(value_after)):
+                changed[i] = True
+                break
+    return changed